@@ -1,8 +1,16 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 import sys
 import argparse
 import os
 import subprocess
+import hashlib
+import shutil
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from functools import partial
 from jnpr.junos import Device
 from jnpr.junos.utils.config import Config
 from jnpr.junos.exception import ConnectError
@@ -13,91 +21,249 @@ from jnpr.junos.exception import CommitError
 
 # (c) 2019 - Sebastiaan Koetsier - licensed under MIT license, see license.txt
 
-def startwork(host_device,asset,prefixlist,ipv6):
-    outfile = open("temp.conf", "w")
-    config = "temp.conf"
-    os.system('clear')
-    print ("~ Starting bgpq3 ...")
+IRRSERVER = "rr.ntt.net"
+BGPQ3 = shutil.which("bgpq3")
+BGPQ3TIMEOUT = 300
+DEVICETIMEOUT = 30
+JOBS = 32
+CACHEDIR = os.path.expanduser("~/.cache/filterupdate")
+CACHETTL = 300
+PLACEHOLDER = "FILTERUPDATE-PREFIXLIST"
+FILTERS = {}
+LOGLOCK = threading.Lock()
+
+def log(message):
+    # getfilter and applyfilter run in worker threads, keep their lines whole
+    with LOGLOCK:
+        print (message)
+
+def cachepath(assets,ipv6):
+    key = "{0}|{1}|{2}".format(IRRSERVER, ",".join(assets), ipv6)
+    return os.path.join(CACHEDIR, hashlib.sha1(key.encode()).hexdigest() + ".conf")
+
+def readcache(path,cachettl):
+    # IRR data changes on NRTM timescales, so a filter generated a few
+    # minutes ago is as good as a fresh bgpq3 run.
+    # Returns (mtime, filter) so callers can age the entry the same way.
+    try:
+        with open(path, 'r') as fin:
+            mtime = os.fstat(fin.fileno()).st_mtime
+            if time.time() - mtime >= cachettl:
+                return None
+            prefixfilter = fin.read()
+    except (IOError, OSError):
+        return None
+    # Anything bgpq3 produced for us carries the placeholder name, an entry
+    # without it is not ours or not complete.
+    if PLACEHOLDER not in prefixfilter:
+        return None
+    return (mtime, prefixfilter)
+
+def writecache(path,prefixfilter):
+    try:
+        os.makedirs(CACHEDIR, exist_ok=True)
+        # Write next to the entry and rename it into place, so readers see
+        # either the old entry or the complete new one, never a partial file.
+        fd, tmppath = tempfile.mkstemp(dir=CACHEDIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                fout.write(prefixfilter)
+            os.replace(tmppath, path)
+        except (IOError, OSError):
+            os.remove(tmppath)
+            raise
+    except (IOError, OSError) as err:
+        log ("-- Unable to write filter cache: {0}".format(err))
+
+def runbgpq3(assets,ipv6):
+    if BGPQ3 is None:
+        log ("-- Unable to find bgpq3 in PATH")
+        return None
+    log ("~ Starting bgpq3 ...")
+    cmd = [BGPQ3, "-J", "-l", PLACEHOLDER, "-h", IRRSERVER]
     if ipv6 == True:
-        subprocess.call(["bgpq3", "-J", asset,"-l",prefixlist,"-6","-h","rr.ntt.net"], stdout=outfile)
+        cmd.append("-6")
+    # bgpq3 expands all AS-SETs over one pipelined IRR connection
+    cmd.extend(assets)
+    try:
+        bgpq3 = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, timeout=BGPQ3TIMEOUT)
+    except subprocess.TimeoutExpired:
+        log ("-- bgpq3 did not finish within {0} seconds".format(BGPQ3TIMEOUT))
+        return None
+    except OSError as err:
+        log ("-- Unable to run bgpq3: {0}".format(err))
+        return None
+    if bgpq3.returncode != 0:
+        log ("-- bgpq3 failed with exit code {0}".format(bgpq3.returncode))
+        return None
+    if PLACEHOLDER not in bgpq3.stdout:
+        log ("-- bgpq3 did not produce a prefix-list")
+        return None
+    return bgpq3.stdout
+
+def getfilter(assets,prefixlist,ipv6,cachettl):
+    # bgpq3 output only depends on the AS-SETs and the family, so filters are
+    # generated and cached under PLACEHOLDER and renamed on the way out. This
+    # lets one bgpq3 run serve every prefix-list built from the same AS-SETs,
+    # both in this process (FILTERS) and across runs (the disk cache).
+    key = (tuple(assets), ipv6)
+    cache = cachepath(assets,ipv6)
+    if key in FILTERS and time.time() - FILTERS[key][0] < cachettl:
+        prefixfilter = FILTERS[key][1]
     else:
-        subprocess.call(["bgpq3", "-J", asset,"-l",prefixlist,"-h","rr.ntt.net"], stdout=outfile)
-    outfile.close()
+        cached = readcache(cache, cachettl)
+        if cached is not None:
+            log ("~ Using cached filter {0}".format(cache))
+            # Stamped with the entry's mtime, so the memo expires with it
+            FILTERS[key] = cached
+            prefixfilter = cached[1]
+        else:
+            prefixfilter = runbgpq3(assets, ipv6)
+            if prefixfilter is None:
+                return None
+            FILTERS[key] = (time.time(), prefixfilter)
+            writecache(cache, prefixfilter)
+    return prefixfilter.replace(PLACEHOLDER, prefixlist)
+
+def mergefilters(prefixfilters):
+    prefixfilters = [prefixfilter.result() for prefixfilter in prefixfilters]
+    if None in prefixfilters:
+        return None
+    prefixfilter = "".join(prefixfilters)
 
-    with open(config, 'r') as fin:
-        print ("======[ Writing prefix filter ]======")
-        print fin.read()
-        print ("======[ Done writing filter ]======")
+    log ("======[ Writing prefix filter ]======")
+    log (prefixfilter)
+    log ("======[ Done writing filter ]======")
 
-    print ("======[ Action log ]======")
+    log ("======[ Action log ]======")
+    return prefixfilter
 
+def applyfilter(host_device,prefixfilter,devicetimeout):
+    log ("~ Connecting to {0} ...".format(host_device))
     try:
-        dev = Device(host=host_device)
+        # Facts are never used, don't spend a handful of RPCs collecting them
+        dev = Device(host=host_device, gather_facts=False, conn_open_timeout=devicetimeout)
         dev.open()
     except ConnectError as err:
-        print ("-- Unable to connect to: {0}".format(err))
-        return
+        log ("-- [{0}] Unable to connect to: {1}".format(host_device, err))
+        return False
+
+    # prefixfilter is the future of the shared bgpq3 run, only wait for it
+    # once the session is up.
+    try:
+        prefixfilter = prefixfilter.result()
+        if prefixfilter is None:
+            log ("-- [{0}] No prefix filter, not touching the device".format(host_device))
+            return False
+        # RPC timeouts and dropped sessions are not wrapped in the specific
+        # errors commitfilter handles, keep them from aborting the other
+        # devices and the summary.
+        try:
+            return commitfilter(dev, host_device, prefixfilter)
+        except Exception as err:
+            log ("-- [{0}] Unable to update the configuration: {1}".format(host_device, err))
+            return False
+    finally:
+        dev.close()
 
+def commitfilter(dev,host_device,prefixfilter):
     dev.bind(cu=Config)
 
-    print ("++ Locking configuration")
+    log ("++ [{0}] Locking configuration".format(host_device))
     try:
         dev.cu.lock()
     except LockError as err:
-        print ("-- Unable to lock configuration {0}".format(err))
-        return
+        log ("-- [{0}] Unable to lock configuration {1}".format(host_device, err))
+        return False
 
-    print ("++ Loading prefixlist configuration")
+    log ("++ [{0}] Loading prefixlist configuration".format(host_device))
     try:
-        dev.cu.load(path=config,replace=True)
+        dev.cu.load(prefixfilter,format='text',replace=True)
     except (ConfigLoadError, Exception) as err:
-        print ("-- Unable to load configuration changes: {0}".format(err))
-        print ("++ Unlocking configuration")
+        log ("-- [{0}] Unable to load configuration changes: {1}".format(host_device, err))
+        log ("++ [{0}] Unlocking configuration".format(host_device))
         try:
             dev.cu.unlock()
         except UnlockError:
-            print ("-- Unable to unlock configuration: {0}".format(err))
-        dev.close()
-        return
+            log ("-- [{0}] Unable to unlock configuration: {1}".format(host_device, err))
+        return False
 
-    print ("++ Committing the configuration")
+    log ("++ [{0}] Committing the configuration".format(host_device))
     try:
         dev.cu.commit(comment='Prefix filter update')
     except CommitError as err:
-        print ("-- Unable to commit configuration: {0}".format(err))
-        print ("++ Unlocking the configuration")
+        log ("-- [{0}] Unable to commit configuration: {1}".format(host_device, err))
+        log ("++ [{0}] Unlocking the configuration".format(host_device))
         try:
             dev.cu.unlock()
         except UnlockError as err:
-            print ("-- Unable to unlock configuration: {0}".format(err))
-        dev.close()
-        return
+            log ("-- [{0}] Unable to unlock configuration: {1}".format(host_device, err))
+        return False
 
-    print ("++ Unlocking the configuration")
+    log ("++ [{0}] Unlocking the configuration".format(host_device))
     try:
         dev.cu.unlock()
     except UnlockError as err:
-        print ("-- Unable to unlock configuration: {0}".format(err))
+        log ("-- [{0}] Unable to unlock configuration: {1}".format(host_device, err))
 
-    dev.close()
-    os.remove(config)
-    exit(0)
+    return True
 
+def startwork(host_devices,assets,prefixlist,ipv6,both,cachettl,jobs,devicetimeout):
+    families = [(prefixlist, ipv6)]
+    if both == True:
+        families = [(prefixlist, False), (prefixlist + "-v6", True)]
 
-def main():
+    # The filter is the same for every device, so bgpq3 runs once per family
+    # while the devices connect in parallel; bgpq3 and NETCONF are both I/O
+    # bound, so threads are fine. The bgpq3 jobs are queued first so that the
+    # workers waiting on them can never starve them of a thread.
+    with ThreadPoolExecutor(max_workers=min(jobs,len(host_devices)) + len(families) + 1) as pool:
+        prefixfilters = [pool.submit(getfilter, assets, name, family, cachettl) for name, family in families]
+        prefixfilter = pool.submit(mergefilters, prefixfilters)
+        results = list(pool.map(partial(applyfilter, prefixfilter=prefixfilter, devicetimeout=devicetimeout), host_devices))
+
+    print ("======[ Summary ]======")
+    for host_device, result in zip(host_devices, results):
+        if result:
+            print ("++ [{0}] Prefix filter updated".format(host_device))
+        else:
+            print ("-- [{0}] Prefix filter not updated".format(host_device))
+    return all(results)
+
+
+@lru_cache(maxsize=1)
+def buildparser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', action='store', type=str, help="Which device to use", dest="host_device", required=True)
-    parser.add_argument('-a', action='store', type=str, help="AS-SET to create prefixlist", dest="asset", required=True)
+    parser.add_argument('-d', action='store', nargs='+', type=str, help="Which device(s) to use", dest="host_devices", required=True)
+    parser.add_argument('-a', action='store', nargs='+', type=str, help="AS-SET(s) to create prefixlist", dest="assets", required=True)
     parser.add_argument('-l', action='store', type=str, help="prefix-list name", dest="prefixlist", required=True)
-    parser.add_argument('-6', action='store_true', default=False, help="Use IPv6", dest="ipv6", required=False)
-    args = parser.parse_args()
+    family = parser.add_mutually_exclusive_group()
+    family.add_argument('-6', action='store_true', default=False, help="Use IPv6", dest="ipv6", required=False)
+    family.add_argument('--both', action='store_true', default=False, help="Build IPv4 and IPv6 lists, the IPv6 list is named <prefix-list>-v6", dest="both", required=False)
+    parser.add_argument('--no-cache', action='store_true', default=False, help="Ignore cached filters and re-run bgpq3", dest="nocache", required=False)
+    parser.add_argument('--cache-ttl', action='store', type=int, default=CACHETTL, help="Seconds a cached filter stays valid (default: %(default)s)", dest="cachettl", required=False)
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=JOBS, help="Number of devices to update at once (default: %(default)s)", dest="jobs", required=False)
+    parser.add_argument('--device-timeout', action='store', type=int, default=DEVICETIMEOUT, help="Seconds to wait for a device connection (default: %(default)s)", dest="devicetimeout", required=False)
+    return parser
 
-    host_device = '%s' % (args.host_device)
-    asset = '%s' % (args.asset)
+def main():
+    args = buildparser().parse_args()
+
+    host_devices = (args.host_devices)
+    assets = (args.assets)
     prefixlist = '%s' % (args.prefixlist)
     ipv6 = (args.ipv6)
+    both = (args.both)
+    cachettl = 0 if args.nocache else (args.cachettl)
+    jobs = max(1, args.jobs)
+    devicetimeout = (args.devicetimeout)
+
+    if BGPQ3 is None:
+        print ("-- Unable to find bgpq3 in PATH")
+        sys.exit(2)
 
-    startwork(host_device,asset,prefixlist,ipv6)
+    if startwork(host_devices,assets,prefixlist,ipv6,both,cachettl,jobs,devicetimeout):
+        sys.exit(0)
     sys.exit(2)
 
 if __name__ == "__main__":